@@ -5,6 +5,11 @@ import os, platform, sys, shutil, datetime, time, errno, functools
 import hashlib # for sha1sum
 import subprocess # for calling shell command
 import natsort # natural sort folder name
+import concurrent.futures # parallel checkout
+try:
+    import fcntl # for reflink (FICLONE)
+except ImportError:
+    fcntl = None
 
 if platform.system() == 'Linux':
     # Check if the script is run as root (UID 0)
@@ -38,6 +43,12 @@ class gvars:
         self.auto_save_period = 120 # time (seconds) period of auto-save to .pbu-new-asv
         self.print_period = 30 # time (seconds) period of printing a line of report, use -1 to print every file before using '\r' to erase it
 
+        # `pbu.py checkout [version folder] [target folder]`
+        self.checkout_threads = 8 # number of files copied in parallel
+        self.checkout_reflink = True # try reflink (copy-on-write clone) before copying, falls back to copy if not supported
+        self.checkout_hardlink = False # hardlink instead of copy (restored files share inode with the backup, editing one edits both!)
+        self.checkout_verify = True # check sha1 of every restored file against .pbu
+
         # ================ internal constants ===================
         # .pbu line forma
         self.beg_size = 0; self.end_size = 14 # size string (14)
@@ -94,6 +105,13 @@ def print_tmp_line(str):
             print(str, flush=True)
             last_print_time = current_time
 
+# check if file name ends with one of `g.ignore_ext`
+def name_ignored_ext(name):
+    for ext in g.ignore_ext:
+        if name[-len(ext):] == ext:
+            return True
+    return False
+
 # generate .pbu
 # return list of lines of in `.pbu` format
 # write to file if fname provided
@@ -129,11 +147,7 @@ def size_time_sha1_cwd(fname=None, pbu=None, pbu_asv=None):
                 print('### warning: symlink is currently not supported! ignored!')
                 warn_link = False
             continue
-        f_ignored = False
-        for ext in g.ignore_ext:
-            if name[-len(ext):] == ext:
-                f_ignored = True; break
-        if f_ignored:
+        if name_ignored_ext(name):
             continue
         # get size and time
         size_str = '%014d' % os.stat(f).st_size
@@ -585,14 +599,227 @@ def backup1(folder):
     print('done.', flush=True)
     return need_rerun
 
+# ============ checkout a backup version ==============
+
+FICLONE = 0x40049409 # linux ioctl, clone file extents (reflink)
+reflink_ok = True # set to False after the first failed reflink
+
+# clone file `src` to `dst` with reflink, return False if not supported
+def reflink_file(src, dst):
+    global reflink_ok
+    if fcntl is None or not reflink_ok:
+        return False
+    with open(src, 'rb') as fsrc, open(dst, 'wb') as fdst:
+        try:
+            fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+        except OSError as exc:
+            if exc.errno in (errno.EOPNOTSUPP, errno.ENOTTY, errno.EXDEV, errno.EINVAL, errno.ENOSYS):
+                reflink_ok = False
+                return False
+            raise
+    shutil.copystat(src, dst)
+    return True
+
+# restore a single missing file from backup (run in worker threads)
+# return an error message, or '' if ok
+def checkout_file(src, dst, sha1str):
+    try:
+        if g.checkout_hardlink:
+            try:
+                os.link(src, dst)
+            except OSError:
+                shutil.copy2(src, dst)
+        elif not (g.checkout_reflink and reflink_file(src, dst)):
+            shutil.copy2(src, dst) # will preserve metadata
+    except OSError:
+        if os.path.lexists(dst): # partly written
+            os.remove(dst)
+        raise
+    if g.checkout_verify:
+        try:
+            sha1str_dst = sha1file(dst)
+        except SystemExit: # sha1file() exits on PermissionError
+            return 'no permission to read file: ' + dst
+        if sha1str_dst != sha1str:
+            # has size and time of the backup, a rerun would skip it
+            os.remove(dst)
+            return 'sha1 mismatch: ' + dst
+    return ''
+
+# materialize the latest backup version folder `src` (with .pbu) into `target`
+# only missing files are restored, a file in `target` is up to date if size and sha1
+# match (sha1 from `target/.pbu`, or size and time in lazy mode, or hashed)
+# files that differ are listed as [changed] and nothing is restored
+# return True if review is needed
+def checkout(src, target):
+    if src[-1] != '/': src += '/'
+    if target[-1] != '/': target += '/'
+    if not os.path.exists(src + '.pbu'):
+        print('.pbu not found in [{}], not a backup version folder!'.format(src))
+        exit(1)
+    # older versions only keep the files not moved to the next version
+    dest1, folder_ver = os.path.split(os.path.abspath(src))
+    if dest1[-4:] == '.pbu':
+        backups = natsort.natsorted(next(os.walk(dest1))[1])
+        if folder_ver != backups[-1]:
+            print('[{}] is not the latest version [{}], only the latest version is a full backup!'.format(folder_ver, backups[-1]))
+            exit(1)
+    real_src = os.path.realpath(src) + '/'; real_target = os.path.realpath(target) + '/'
+    if real_target.startswith(real_src) or real_src.startswith(real_target):
+        print('[{}] and [{}] overlap, please checkout to another folder!'.format(src, target))
+        exit(1)
+    try:
+        os.makedirs(target, exist_ok=True)
+    except OSError as exc:
+        print('cannot create [{}] ({})'.format(target, exc))
+        exit(1)
+    with open(src + '.pbu', 'r') as f:
+        pbu = [line for line in f.read().splitlines() if line]
+    hash_name = os.path.exists(src + '.pbu-hashname')
+
+    # create dict from '[size] [time] [path]' to [sha1] of target
+    hash_dict = {}
+    if os.path.exists(target + '.pbu'):
+        with open(target + '.pbu', 'r') as f:
+            for line in f.read().splitlines():
+                key = line[:g.end_time] + line[g.beg_path-1:]
+                hash_dict[key] = line[g.beg_hash:g.end_hash]
+
+    # decide which files to copy
+    # `pbu_new` is the .pbu of target, files skipped by size and time are not hashed and left out
+    print('checking [{}]...'.format(target), flush=True)
+    jobs = []; pbu_new = []; changed = []; Nskip = Nlazy = 0
+    Nf = len(pbu)
+    for i in range(Nf):
+        line = pbu[i]
+        size_str = line[:g.end_size]; time_str = line[g.beg_time:g.end_time]
+        sha1str = line[g.beg_hash:g.end_hash]; path = line[g.beg_path:]
+        dst = target + path
+        if os.path.isfile(dst) and not os.path.islink(dst):
+            dst_size = '%014d' % os.stat(dst).st_size
+            dst_time = datetime.datetime.fromtimestamp(os.path.getmtime(dst)).strftime('%Y%m%d.%H%M%S')
+            key = dst_size + ' ' + dst_time + ' ' + path
+            if dst_size != size_str:
+                sha1str_dst = ''
+            elif key in hash_dict: # known sha1, never fall back to size and time
+                sha1str_dst = hash_dict[key]
+            elif g.lazy_mode and dst_time == time_str:
+                Nskip += 1; Nlazy += 1; continue
+            else:
+                print_tmp_line('[{}/{}] (hash) {}'.format(i+1, Nf, path))
+                sha1str_dst = sha1file(dst)
+            if sha1str_dst == sha1str:
+                pbu_new.append(dst_size + ' ' + dst_time + ' ' + sha1str + ' ' + path)
+                Nskip += 1; continue
+            changed.append(path); continue
+        elif os.path.lexists(dst): # folder or symlink
+            changed.append(path); continue
+        if hash_name:
+            src1 = src + os.path.join(os.path.split(path)[0], sha1str)
+        else:
+            src1 = src + path
+        jobs.append((src1, dst, sha1str, int(size_str), path))
+    print('files up to date:', Nskip)
+    print('files to restore:', len(jobs), '\n', flush=True)
+
+    # never overwrite files in target, they might be newer
+    if changed:
+        for path in changed:
+            print('[changed] ' + path)
+        print('{} file(s) in [{}] differ from the version, nothing restored. review and move them away, then rerun.\n'.format(len(changed), target), flush=True)
+        return True
+
+    # ensure dest paths exist (before starting threads)
+    errors = []
+    for dir in sorted({os.path.split(job[1])[0] for job in jobs}):
+        try:
+            os.makedirs(dir, exist_ok=True)
+        except OSError as exc:
+            err = 'failed: {} ({})'.format(dir, exc)
+            print(err, flush=True)
+            errors.append(err)
+
+    # copy in parallel, biggest files first to keep all threads busy
+    jobs.sort(key=lambda job: -job[3])
+    Nbytes = 0; Ndone = 0; Njob = len(jobs)
+    t0 = time.time()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=g.checkout_threads) as pool:
+        futures = {pool.submit(checkout_file, *job[:3]): job for job in jobs}
+        for future in concurrent.futures.as_completed(futures):
+            job = futures[future]
+            Ndone += 1
+            try:
+                err = future.result()
+            except OSError as exc:
+                err = 'failed: {} ({})'.format(job[1], exc)
+            if err:
+                print(err, flush=True)
+                errors.append(err)
+            else:
+                Nbytes += job[3]
+                time_str = datetime.datetime.fromtimestamp(os.path.getmtime(job[1])).strftime('%Y%m%d.%H%M%S')
+                pbu_new.append('%014d' % job[3] + ' ' + time_str + ' ' + job[2] + ' ' + job[4])
+            print_tmp_line('[{}/{}] {}'.format(Ndone, Njob, job[4]))
+    dt = max(time.time() - t0, 1e-6)
+    print('')
+    print('restored {:.1f} MiB in {:.1f} s ({:.1f} MiB/s)'.format(Nbytes/2**20, dt, Nbytes/2**20/dt))
+
+    # keep .pbu of target for the next checkout or backup (also if some files failed)
+    pbu_new.sort(key=functools.cmp_to_key(pbu_line_cmp))
+    if os.path.exists(target + '.pbu'):
+        os.rename(target + '.pbu', target + '.pbu-old')
+    with open(target + '.pbu', 'w') as f:
+        f.write('\n'.join(pbu_new) + '\n' if pbu_new else '')
+    if Nlazy:
+        print('{} file(s) skipped by size and time are not hashed, left out of .pbu'.format(Nlazy))
+
+    if errors:
+        print('{} file(s) failed, see above. rerun checkout after fixing the backup.\n'.format(len(errors)), flush=True)
+        return True
+
+    # files in target but not in the version (ignored the same way as backup)
+    paths = {line[g.beg_path:] for line in pbu}
+    extra = []
+    for f in file_list_r(target):
+        path = f[len(target):]
+        if path in paths or os.path.islink(f):
+            continue
+        dirs = path.split('/')
+        name = dirs.pop()
+        if name in g.ignore or name_ignored_ext(name) or g.ignore_folders.intersection(dirs):
+            continue
+        extra.append(path)
+    extra.sort()
+    if extra:
+        for path in extra:
+            print('[extra]   ' + path)
+        print('{} file(s) in [{}] are not in the version, review and delete them if needed.\n'.format(len(extra), target), flush=True)
+        return True
+    print('done.\n', flush=True)
+    return False
+
+def checkout_main(argv):
+    if len(argv) != 2:
+        print('usage: pbu.py checkout [version folder] [target folder]')
+        exit(1)
+    init_ignore()
+    if checkout(argv[0], argv[1]):
+        print('--------- review & rerun needed ----------')
+    else:
+        print('---------------- all done ----------------')
+
 
 ## =========== main() program ==============
 
+# pbu files are not part of the backup
+def init_ignore():
+    g.ignore.update({'.pbu', '.pbu-old', '.pbu-new', '.pbu-diff',
+                    'pbu-norehash', '.pbu-new-asv', '.pbu-new-asv-writing'})
+
 def main():
     if g.base_path[-1] != '/': g.base_path += '/'
     if g.dest[-1] != '/': g.dest += '/'
-    g.ignore.update({'.pbu', '.pbu-old', '.pbu-new', '.pbu-diff',
-                    'pbu-norehash', '.pbu-new-asv', '.pbu-new-asv-writing'})
+    init_ignore()
     if not g.ver:
         g.ver = datetime.datetime.now().strftime('%Y%m%d.%H%M%S')
 
@@ -649,4 +876,7 @@ def main():
     else:
         print('---------------- all done ----------------')
 
-main()
+if len(sys.argv) > 1 and sys.argv[1] == 'checkout':
+    checkout_main(sys.argv[2:])
+else:
+    main()